@@ -1,13 +1,21 @@
+import asyncio
+import functools
 import logging
 import os
-from dataclasses import dataclass
-from typing import Dict, Optional
-
-import requests
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Deque, Dict, Optional, Tuple
+
+import httpx
+import orjson
+from redis.asyncio import Redis
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     ConversationHandler,
     MessageHandler,
@@ -33,137 +41,415 @@ def read_token_from_file(path: str) -> Optional[str]:
         return None
 
 
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") or read_token_from_file(TOKEN_FILE)
+@functools.lru_cache(maxsize=1)
+def get_bot_token() -> Optional[str]:
+    return os.getenv("TELEGRAM_BOT_TOKEN") or read_token_from_file(TOKEN_FILE)
+
+
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 
 SET_WEIGHT, SET_HEIGHT, SET_AGE, SET_ACTIVITY, SET_CITY, SET_CAL_GOAL = range(6)
 FOOD_GRAMS = 10
 
+_DECIMAL_COMMA = str.maketrans({",": "."})
+
+WEATHER_NOTE_TEMPLATE = "Температура в городе {city}: {temp_c:.1f}°C. ".format
+WEATHER_UNKNOWN_NOTE = "Температура не определена (нет ключа или ошибка API). "
+PROFILE_SAVED_TEMPLATE = (
+    "Профиль сохранен!\n"
+    "{weather_note}"
+    "Норма воды: {water_goal:.0f} мл.\n"
+    "Норма калорий: {calorie_goal:.0f} ккал."
+).format
+PROGRESS_TEMPLATE = (
+    "📊 Прогресс:\n"
+    "Вода:\n"
+    "- Выпито: {logged_water:.0f} мл из {water_goal:.0f} мл.\n"
+    "- Осталось: {water_left:.0f} мл.\n\n"
+    "Калории:\n"
+    "- Потреблено: {consumed:.0f} ккал из {calorie_goal:.0f} ккал.\n"
+    "- Сожжено: {burned:.0f} ккал.\n"
+    "- Баланс: {net:.0f} ккал.\n"
+    "- Осталось до цели: {remaining:.0f} ккал."
+).format
+
+WEATHER_TTL_SEC = 600
+WEATHER_CACHE_MAX = 1024
+FOOD_CACHE_MAX = 2048
+USERS_MAX = 10_000
+PENDING_FOOD_TTL_SEC = 600
+
+RETRY_ATTEMPTS = 2
+RETRY_BASE_DELAY_SEC = 0.3
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN_SEC = 60
+
+# kcal per minute for a 70 kg person
+WORKOUT_KCAL_PER_MIN = {
+    "run": 10,
+    "running": 10,
+    "jog": 8,
+    "walk": 4,
+    "walking": 4,
+    "bike": 8,
+    "cycling": 8,
+    "swim": 9,
+    "gym": 6,
+    "hiit": 12,
+    "yoga": 3,
+}
+
 
 @dataclass
 class PendingFood:
     name: str
     kcal_per_100g: float
+    created_at: float = field(default_factory=time.time)
+
+
+@dataclass(slots=True)
+class UserState:
+    weight: Optional[float] = None
+    height: Optional[float] = None
+    age: Optional[float] = None
+    activity: Optional[float] = None
+    city: Optional[str] = None
+    water_goal: Optional[float] = None
+    calorie_goal: Optional[float] = None
+    logged_water: float = 0.0
+    logged_calories: float = 0.0
+    burned_calories: float = 0.0
+    pending_food: Optional[PendingFood] = None
+
+
+@dataclass(slots=True)
+class ProfileDraft:
+    # Answers collected during /set_profile, kept in context.user_data["draft"].
+    weight: Optional[float] = None
+    height: Optional[float] = None
+    age: Optional[float] = None
+    activity: Optional[float] = None
+    city: Optional[str] = None
+    weather: Optional["asyncio.Task[Optional[float]]"] = None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Different chats run in parallel; updates from one chat run one at a time and
+    # in order, so ConversationHandler sees each state change before the next message.
+    # A busy chat's later updates are handed to the update already running for it and
+    # give their concurrency slot back, so one chat's burst cannot stall the others.
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(max_concurrent_updates)
+        self._backlogs: Dict[int, Deque[Awaitable[Any]]] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+
+        backlog = self._backlogs.get(chat.id)
+        if backlog is not None:
+            backlog.append(coroutine)
+            return
+
+        backlog = self._backlogs[chat.id] = deque()
+        try:
+            while True:
+                try:
+                    await coroutine
+                except Exception:  # noqa: BLE001 - keep draining this chat's backlog
+                    logger.exception("Update processing failed for chat %s", chat.id)
+                if not backlog:
+                    break
+                coroutine = backlog.popleft()
+        finally:
+            del self._backlogs[chat.id]
+            for pending in backlog:
+                if asyncio.iscoroutine(pending):
+                    pending.close()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+@dataclass(slots=True)
+class Breaker:
+    # Fails fast for BREAKER_COOLDOWN_SEC after BREAKER_THRESHOLD failures in a row.
+    fails: int = 0
+    open_until: float = 0.0
+
+    def is_open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    def record(self, ok: bool) -> None:
+        if ok:
+            self.fails = 0
+            return
+        self.fails += 1
+        # fails is only cleared by a success, so one failed probe after the cooldown reopens it.
+        if self.fails >= BREAKER_THRESHOLD:
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN_SEC
+
+
+# Without REDIS_URL profiles live in this dict and are lost on restart.
+# Least recently active users first; the oldest are evicted past USERS_MAX.
+users: "OrderedDict[int, UserState]" = OrderedDict()
+redis_client: Optional[Redis] = Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+NUMERIC_FIELDS = (
+    "weight",
+    "height",
+    "age",
+    "activity",
+    "water_goal",
+    "calorie_goal",
+    "logged_water",
+    "logged_calories",
+    "burned_calories",
+)
+# city (normalized) -> (fetched_at, temp_c)
+_weather_cache: Dict[str, Tuple[float, float]] = {}
+# query (normalized) -> (product_name, kcal_per_100g), least recently used first
+_food_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+_weather_breaker = Breaker()
+_food_breaker = Breaker()
 
 
-users: Dict[int, dict] = {}
+def get_draft(context: ContextTypes.DEFAULT_TYPE) -> ProfileDraft:
+    return context.user_data.setdefault("draft", ProfileDraft())
 
 
-def get_user(user_id: int) -> dict:
-    return users.setdefault(
-        user_id,
-        {
-            "weight": None,
-            "height": None,
-            "age": None,
-            "activity": None,
-            "city": None,
-            "water_goal": None,
-            "calorie_goal": None,
-            "logged_water": 0.0,
-            "logged_calories": 0.0,
-            "burned_calories": 0.0,
-            "pending_food": None,
-        },
-    )
+def local_user(user_id: int) -> UserState:
+    data = users.get(user_id)
+    if data is None:
+        data = users[user_id] = UserState()
+        if len(users) > USERS_MAX:
+            users.popitem(last=False)
+    else:
+        users.move_to_end(user_id)
+    return data
+
+
+def user_key(user_id: int) -> str:
+    return f"u:{user_id}"
+
+
+async def get_user(user_id: int) -> UserState:
+    if redis_client is None:
+        return local_user(user_id)
+
+    raw = await redis_client.hgetall(user_key(user_id))
+    data = UserState(city=raw.get("city"))
+    for name in NUMERIC_FIELDS:
+        if name in raw:
+            setattr(data, name, float(raw[name]))
+    if "pending_name" in raw:
+        data.pending_food = PendingFood(
+            raw["pending_name"], float(raw["pending_kcal"]), float(raw.get("pending_at", 0))
+        )
+    return data
+
+
+async def save_user(user_id: int, fields: dict) -> None:
+    if redis_client is None:
+        data = local_user(user_id)
+        for name, value in fields.items():
+            setattr(data, name, value)
+        return
+
+    mapping = {}
+    dropped = []
+    for name, value in fields.items():
+        if name == "pending_food":
+            if value is None:
+                dropped += ["pending_name", "pending_kcal", "pending_at"]
+            else:
+                mapping["pending_name"] = value.name
+                mapping["pending_kcal"] = value.kcal_per_100g
+                mapping["pending_at"] = value.created_at
+        elif value is None:
+            dropped.append(name)
+        else:
+            mapping[name] = value
+    async with redis_client.pipeline(transaction=True) as pipe:
+        if mapping:
+            pipe.hset(user_key(user_id), mapping=mapping)
+        if dropped:
+            pipe.hdel(user_key(user_id), *dropped)
+        await pipe.execute()
+
+
+async def pop_pending_food(user_id: int) -> Optional[PendingFood]:
+    if redis_client is None:
+        data = local_user(user_id)
+        pending, data.pending_food = data.pending_food, None
+        return pending
+
+    # Read and delete in one MULTI so only one concurrent message can consume the product.
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hmget(user_key(user_id), "pending_name", "pending_kcal", "pending_at")
+        pipe.hdel(user_key(user_id), "pending_name", "pending_kcal", "pending_at")
+        (name, kcal, created_at), _ = await pipe.execute()
+    if name is None or kcal is None:
+        return None
+    return PendingFood(name, float(kcal), float(created_at or 0))
+
+
+async def incr_user(user_id: int, name: str, amount: float) -> float:
+    if redis_client is None:
+        data = local_user(user_id)
+        value = getattr(data, name) + amount
+        setattr(data, name, value)
+        return value
+    # HINCRBYFLOAT is atomic, so concurrent updates from several workers add up.
+    return float(await redis_client.hincrbyfloat(user_key(user_id), name, amount))
 
 
 def parse_float(text: str) -> Optional[float]:
     try:
-        return float(text.replace(",", "."))
+        return float(text)
+    except ValueError:
+        pass
+    # Decimal comma, e.g. "72,5"
+    try:
+        return float(text.translate(_DECIMAL_COMMA))
     except ValueError:
         return None
 
 
-def get_temperature_c(city: str) -> Optional[float]:
+def is_transient(exc: httpx.HTTPError) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    # A stalled read already cost a full read timeout; only a failed connect is cheap to retry.
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+async def get_json(http: httpx.AsyncClient, breaker: Breaker, url: str, params: dict) -> dict:
+    if breaker.is_open():
+        raise CircuitOpenError(f"{url} is temporarily disabled after repeated failures")
+    attempt = 1
+    while True:
+        try:
+            resp = await http.get(url, params=params)
+            resp.raise_for_status()
+        except httpx.PoolTimeout:
+            # All our connections are busy; that says nothing about the remote service.
+            raise
+        except httpx.HTTPError as exc:
+            if is_transient(exc) and attempt < RETRY_ATTEMPTS:
+                await asyncio.sleep(RETRY_BASE_DELAY_SEC * 2 ** (attempt - 1))
+                attempt += 1
+                continue
+            # A client error (e.g. 404 for an unknown city) means the service is healthy.
+            breaker.record(isinstance(exc, httpx.HTTPStatusError) and not is_transient(exc))
+            raise
+        else:
+            breaker.record(True)
+            return orjson.loads(resp.content)
+
+
+async def get_temperature_c(http: httpx.AsyncClient, city: str) -> Optional[float]:
     if not OPENWEATHER_API_KEY:
         return None
+    key = city.strip().lower()
+    cached = _weather_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < WEATHER_TTL_SEC:
+        return cached[1]
     try:
-        resp = requests.get(
+        data = await get_json(
+            http,
+            _weather_breaker,
             "https://api.openweathermap.org/data/2.5/weather",
-            params={"q": city, "appid": OPENWEATHER_API_KEY, "units": "metric"},
-            timeout=10,
+            {"q": city, "appid": OPENWEATHER_API_KEY, "units": "metric"},
         )
-        resp.raise_for_status()
-        data = resp.json()
-        return float(data["main"]["temp"])
+        temp_c = float(data["main"]["temp"])
     except Exception as exc:  # noqa: BLE001 - keep simple for homework
         logger.warning("Weather fetch failed: %s", exc)
         return None
+    if len(_weather_cache) > WEATHER_CACHE_MAX:
+        _weather_cache.clear()
+    _weather_cache[key] = (time.monotonic(), temp_c)
+    return temp_c
 
 
 def calc_water_goal(weight: float, activity_min: float, temp_c: Optional[float]) -> float:
     base = weight * 30.0
     activity_bonus = 500.0 * (activity_min // 30)
-    heat_bonus = 0.0
-    if temp_c is not None:
-        if temp_c > 30:
-            heat_bonus = 1000.0
-        elif temp_c > 25:
-            heat_bonus = 500.0
+    temp = temp_c if temp_c is not None else 0.0
+    # +500 ml above 25°C and another +500 ml above 30°C
+    heat_bonus = 500.0 * (temp > 25) + 500.0 * (temp > 30)
     return base + activity_bonus + heat_bonus
 
 
 def calc_calorie_goal(weight: float, height: float, age: float, activity_min: float) -> float:
     base = 10 * weight + 6.25 * height - 5 * age
-    if activity_min <= 30:
-        activity_bonus = 200
-    elif activity_min <= 60:
-        activity_bonus = 300
-    else:
-        activity_bonus = 400
+    # 200 up to 30 min, 300 up to 60 min, 400 above
+    activity_bonus = 200 + 100 * ((activity_min > 30) + (activity_min > 60))
     return base + activity_bonus
 
 
 def calc_workout_burned(workout_type: str, minutes: float, weight: float) -> float:
-    per_min = {
-        "run": 10,
-        "running": 10,
-        "jog": 8,
-        "walk": 4,
-        "walking": 4,
-        "bike": 8,
-        "cycling": 8,
-        "swim": 9,
-        "gym": 6,
-        "hiit": 12,
-        "yoga": 3,
-    }.get(workout_type.lower(), 5)
-    return minutes * per_min * (weight / 70.0)
-
-
-def search_food_kcal(food_name: str) -> Optional[PendingFood]:
+    return minutes * WORKOUT_KCAL_PER_MIN.get(workout_type.lower(), 5) * (weight / 70.0)
+
+
+async def _fetch_food_kcal(http: httpx.AsyncClient, food_name: str) -> Optional[Tuple[str, float]]:
+    data = await get_json(
+        http,
+        _food_breaker,
+        "https://world.openfoodfacts.org/cgi/search.pl",
+        {
+            "search_terms": food_name,
+            "search_simple": 1,
+            "action": "process",
+            "json": 1,
+            "page_size": 1,
+            # Only what we read below; full product records are tens of KB.
+            "fields": "product_name,nutriments",
+        },
+    )
+    products = data.get("products", [])
+    if not products:
+        return None
+    product = products[0]
+    name = product.get("product_name") or food_name
+    nutriments = product.get("nutriments", {})
+    kcal = nutriments.get("energy-kcal_100g")
+    if kcal is None:
+        energy_kj = nutriments.get("energy_100g")
+        if energy_kj is not None:
+            kcal = float(energy_kj) * 0.239006
+    if kcal is None:
+        return None
+    return name, float(kcal)
+
+
+async def search_food_kcal(http: httpx.AsyncClient, food_name: str) -> Optional[PendingFood]:
+    key = food_name.strip().lower()
+    cached = _food_cache.get(key)
+    if cached is not None:
+        _food_cache.move_to_end(key)
+        return PendingFood(*cached)
     try:
-        resp = requests.get(
-            "https://world.openfoodfacts.org/cgi/search.pl",
-            params={
-                "search_terms": food_name,
-                "search_simple": 1,
-                "action": "process",
-                "json": 1,
-                "page_size": 1,
-            },
-            timeout=10,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        products = data.get("products", [])
-        if not products:
-            return None
-        product = products[0]
-        name = product.get("product_name") or food_name
-        nutriments = product.get("nutriments", {})
-        kcal = nutriments.get("energy-kcal_100g")
-        if kcal is None:
-            energy_kj = nutriments.get("energy_100g")
-            if energy_kj is not None:
-                kcal = float(energy_kj) * 0.239006
-        if kcal is None:
-            return None
-        return PendingFood(name=name, kcal_per_100g=float(kcal))
+        found = await _fetch_food_kcal(http, food_name)
     except Exception as exc:  # noqa: BLE001
         logger.warning("Food fetch failed: %s", exc)
         return None
+    if found is None:
+        return None
+    _food_cache[key] = found
+    if len(_food_cache) > FOOD_CACHE_MAX:
+        _food_cache.popitem(last=False)
+    return PendingFood(*found)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -190,7 +476,7 @@ async def set_weight(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if value is None or value <= 0:
         await update.message.reply_text("Нужно число > 0. Повторите ввод веса.")
         return SET_WEIGHT
-    context.user_data["weight"] = value
+    get_draft(context).weight = value
     await update.message.reply_text("Введите ваш рост (в см):")
     return SET_HEIGHT
 
@@ -200,7 +486,7 @@ async def set_height(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if value is None or value <= 0:
         await update.message.reply_text("Нужно число > 0. Повторите ввод роста.")
         return SET_HEIGHT
-    context.user_data["height"] = value
+    get_draft(context).height = value
     await update.message.reply_text("Введите ваш возраст:")
     return SET_AGE
 
@@ -210,7 +496,7 @@ async def set_age(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if value is None or value <= 0:
         await update.message.reply_text("Нужно число > 0. Повторите ввод возраста.")
         return SET_AGE
-    context.user_data["age"] = value
+    get_draft(context).age = value
     await update.message.reply_text("Сколько минут активности у вас в день?")
     return SET_ACTIVITY
 
@@ -220,7 +506,7 @@ async def set_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     if value is None or value < 0:
         await update.message.reply_text("Нужно число >= 0. Повторите ввод активности.")
         return SET_ACTIVITY
-    context.user_data["activity"] = value
+    get_draft(context).activity = value
     await update.message.reply_text("В каком городе вы находитесь?")
     return SET_CITY
 
@@ -230,7 +516,12 @@ async def set_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not city:
         await update.message.reply_text("Введите название города текстом.")
         return SET_CITY
-    context.user_data["city"] = city
+    draft = get_draft(context)
+    draft.city = city
+    # Fetch the weather while the user is typing the calorie goal.
+    draft.weather = context.application.create_task(
+        get_temperature_c(context.bot_data["http"], city), update=update
+    )
     await update.message.reply_text(
         "Если хотите задать цель по калориям вручную, отправьте число. "
         "Иначе отправьте 0 для автоподбора."
@@ -240,24 +531,28 @@ async def set_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def set_cal_goal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    data = get_user(user_id)
 
-    weight = context.user_data["weight"]
-    height = context.user_data["height"]
-    age = context.user_data["age"]
-    activity = context.user_data["activity"]
-    city = context.user_data["city"]
+    draft = get_draft(context)
+    weight = draft.weight
+    height = draft.height
+    age = draft.age
+    activity = draft.activity
+    city = draft.city
 
     manual_goal = parse_float(update.message.text)
     if manual_goal is None or manual_goal < 0:
         await update.message.reply_text("Нужно число >= 0. Повторите ввод цели.")
         return SET_CAL_GOAL
 
-    temp_c = get_temperature_c(city)
+    if draft.weather is not None:
+        temp_c = await draft.weather
+    else:
+        temp_c = await get_temperature_c(context.bot_data["http"], city)
     water_goal = calc_water_goal(weight, activity, temp_c)
     calorie_goal = manual_goal if manual_goal > 0 else calc_calorie_goal(weight, height, age, activity)
 
-    data.update(
+    await save_user(
+        user_id,
         {
             "weight": weight,
             "height": height,
@@ -266,20 +561,21 @@ async def set_cal_goal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             "city": city,
             "water_goal": water_goal,
             "calorie_goal": calorie_goal,
-        }
+        },
     )
 
     weather_note = (
-        f"Температура в городе {city}: {temp_c:.1f}°C. "
+        WEATHER_NOTE_TEMPLATE(city=city, temp_c=temp_c)
         if temp_c is not None
-        else "Температура не определена (нет ключа или ошибка API). "
+        else WEATHER_UNKNOWN_NOTE
     )
 
     await update.message.reply_text(
-        "Профиль сохранен!\n"
-        f"{weather_note}"
-        f"Норма воды: {water_goal:.0f} мл.\n"
-        f"Норма калорий: {calorie_goal:.0f} ккал."
+        PROFILE_SAVED_TEMPLATE(
+            weather_note=weather_note,
+            water_goal=water_goal,
+            calorie_goal=calorie_goal,
+        )
     )
     context.user_data.clear()
     return ConversationHandler.END
@@ -287,8 +583,8 @@ async def set_cal_goal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 async def log_water(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    data = get_user(user_id)
-    if data["weight"] is None:
+    data = await get_user(user_id)
+    if data.weight is None:
         await update.message.reply_text("Сначала настройте профиль: /set_profile")
         return
 
@@ -301,8 +597,8 @@ async def log_water(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Введите количество воды в мл (число > 0).")
         return
 
-    data["logged_water"] += amount
-    remaining = max(data["water_goal"] - data["logged_water"], 0)
+    logged_water = await incr_user(user_id, "logged_water", amount)
+    remaining = max(data.water_goal - logged_water, 0)
     await update.message.reply_text(
         f"Записано: {amount:.0f} мл. Осталось: {remaining:.0f} мл до нормы."
     )
@@ -310,8 +606,8 @@ async def log_water(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def log_food(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    data = get_user(user_id)
-    if data["weight"] is None:
+    data = await get_user(user_id)
+    if data.weight is None:
         await update.message.reply_text("Сначала настройте профиль: /set_profile")
         return ConversationHandler.END
 
@@ -320,12 +616,12 @@ async def log_food(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
 
     food_name = " ".join(context.args).strip()
-    pending = search_food_kcal(food_name)
+    pending = await search_food_kcal(context.bot_data["http"], food_name)
     if pending is None:
         await update.message.reply_text("Не нашел продукт или калорийность. Попробуйте другой запрос.")
         return ConversationHandler.END
 
-    data["pending_food"] = pending
+    await save_user(user_id, {"pending_food": pending})
     await update.message.reply_text(
         f"{pending.name} — {pending.kcal_per_100g:.0f} ккал на 100 г. Сколько грамм вы съели?"
     )
@@ -334,8 +630,12 @@ async def log_food(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def log_food_grams(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    data = get_user(user_id)
-    pending: Optional[PendingFood] = data.get("pending_food")
+    data = await get_user(user_id)
+    pending = data.pending_food
+    if pending is not None and time.time() - pending.created_at > PENDING_FOOD_TTL_SEC:
+        # The user walked away from /log_food; drop the stale product.
+        await pop_pending_food(user_id)
+        pending = None
     if pending is None:
         await update.message.reply_text("Нет активного продукта. Введите /log_food <продукт>.")
         return ConversationHandler.END
@@ -345,17 +645,21 @@ async def log_food_grams(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Введите граммы числом > 0.")
         return FOOD_GRAMS
 
+    pending = await pop_pending_food(user_id)
+    if pending is None:
+        # Another message for the same product was logged in the meantime.
+        return ConversationHandler.END
+
     kcal = pending.kcal_per_100g * grams / 100.0
-    data["logged_calories"] += kcal
-    data["pending_food"] = None
+    await incr_user(user_id, "logged_calories", kcal)
     await update.message.reply_text(f"Записано: {kcal:.1f} ккал.")
     return ConversationHandler.END
 
 
 async def log_workout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    data = get_user(user_id)
-    if data["weight"] is None:
+    data = await get_user(user_id)
+    if data.weight is None:
         await update.message.reply_text("Сначала настройте профиль: /set_profile")
         return
 
@@ -369,8 +673,8 @@ async def log_workout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text("Минуты должны быть числом > 0.")
         return
 
-    burned = calc_workout_burned(workout_type, minutes, data["weight"])
-    data["burned_calories"] += burned
+    burned = calc_workout_burned(workout_type, minutes, data.weight)
+    await incr_user(user_id, "burned_calories", burned)
 
     extra_water = 200 * (minutes // 30)
     await update.message.reply_text(
@@ -381,45 +685,72 @@ async def log_workout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 async def check_progress(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    data = get_user(user_id)
-    if data["weight"] is None:
+    data = await get_user(user_id)
+    if data.weight is None:
         await update.message.reply_text("Сначала настройте профиль: /set_profile")
         return
 
-    water_goal = data["water_goal"]
-    water_left = max(water_goal - data["logged_water"], 0)
+    water_goal = data.water_goal
+    water_left = max(water_goal - data.logged_water, 0)
 
-    calorie_goal = data["calorie_goal"]
-    consumed = data["logged_calories"]
-    burned = data["burned_calories"]
+    calorie_goal = data.calorie_goal
+    consumed = data.logged_calories
+    burned = data.burned_calories
     net = consumed - burned
     remaining = max(calorie_goal - net, 0)
 
-    text = (
-        "📊 Прогресс:\n"
-        "Вода:\n"
-        f"- Выпито: {data['logged_water']:.0f} мл из {water_goal:.0f} мл.\n"
-        f"- Осталось: {water_left:.0f} мл.\n\n"
-        "Калории:\n"
-        f"- Потреблено: {consumed:.0f} ккал из {calorie_goal:.0f} ккал.\n"
-        f"- Сожжено: {burned:.0f} ккал.\n"
-        f"- Баланс: {net:.0f} ккал.\n"
-        f"- Осталось до цели: {remaining:.0f} ккал."
+    text = PROGRESS_TEMPLATE(
+        logged_water=data.logged_water,
+        water_goal=water_goal,
+        water_left=water_left,
+        consumed=consumed,
+        calorie_goal=calorie_goal,
+        burned=burned,
+        net=net,
+        remaining=remaining,
     )
     await update.message.reply_text(text)
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    draft = context.user_data.get("draft")
+    if draft is not None and draft.weather is not None:
+        draft.weather.cancel()
     context.user_data.clear()
     await update.message.reply_text("Отменено.")
     return ConversationHandler.END
 
 
+async def close_clients(app: Application) -> None:
+    await app.bot_data["http"].aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
 def main() -> None:
-    if not TELEGRAM_BOT_TOKEN:
+    token = get_bot_token()
+    if not token:
         raise RuntimeError("Set TELEGRAM_BOT_TOKEN env var")
 
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        # Chats are handled in parallel, each chat's updates in order; replies share a pool.
+        .concurrent_updates(PerChatUpdateProcessor(256))
+        .connection_pool_size(32)
+        .pool_timeout(5)
+        .connect_timeout(10)
+        .read_timeout(10)
+        .post_shutdown(close_clients)
+        .build()
+    )
+    # One client for all handlers: keeps TCP/TLS connections alive between API calls.
+    app.bot_data["http"] = httpx.AsyncClient(
+        # Fail fast on a stalled connect so the circuit breaker can open quickly.
+        timeout=httpx.Timeout(connect=2.0, read=5.0, write=5.0, pool=1.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=8),
+        headers={"User-Agent": "AquaFitBuddy/1.0"},
+    )
 
     profile_conv = ConversationHandler(
         entry_points=[CommandHandler("set_profile", set_profile)],
@@ -449,7 +780,16 @@ def main() -> None:
     app.add_handler(CommandHandler("log_workout", log_workout))
     app.add_handler(CommandHandler("check_progress", check_progress))
 
-    app.run_polling()
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us; no idle getUpdates round-trips.
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8443")),
+            url_path=token,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{token}",
+        )
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+import asyncio
+from datetime import datetime
+from typing import Optional
+
+from telegram import Chat, Message, Update
+
+from bot import PerChatUpdateProcessor
+
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.now(), chat=chat, text="x")
+    return Update(update_id=update_id, message=message)
+
+
+async def record(log: list, name: str, release: Optional[asyncio.Event] = None) -> None:
+    if release is not None:
+        await release.wait()
+    log.append(name)
+
+
+def test_other_chat_runs_while_chat_is_busy():
+    async def scenario():
+        processor = PerChatUpdateProcessor(2)
+        release = asyncio.Event()
+        log = []
+        busy = [
+            asyncio.create_task(processor.process_update(make_update(1, 1), record(log, "a1", release))),
+            asyncio.create_task(processor.process_update(make_update(2, 1), record(log, "a2"))),
+            asyncio.create_task(processor.process_update(make_update(3, 1), record(log, "a3"))),
+        ]
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+        await asyncio.wait_for(processor.process_update(make_update(4, 2), record(log, "b1")), 1)
+        assert log == ["b1"]
+
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*busy), 1)
+        assert log == ["b1", "a1", "a2", "a3"]
+
+    asyncio.run(scenario())
+
+
+def test_chat_updates_keep_their_order():
+    async def scenario():
+        processor = PerChatUpdateProcessor(8)
+        log = []
+
+        async def slow(name: str) -> None:
+            await asyncio.sleep(0.01)
+            log.append(name)
+
+        await asyncio.gather(
+            processor.process_update(make_update(1, 1), slow("weight")),
+            processor.process_update(make_update(2, 1), record(log, "height")),
+        )
+        assert log == ["weight", "height"]
+
+    asyncio.run(scenario())